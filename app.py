@@ -1,20 +1,47 @@
-from flask import Flask, request, jsonify, send_from_directory, send_file
+from quart import Quart, Response, request, jsonify, send_from_directory
 import os
-import tempfile
-from collections import defaultdict
-from openai import OpenAI
-from PyPDF2 import PdfReader
+import json
+import logging
+import asyncio
+import hashlib
+import uuid
+import multiprocessing
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import httpx
+import numpy as np
+from openai import AsyncOpenAI
+
+from pdf_texto import extrair_paginas_pdf
+from prompts import SYSTEM_PROMPT_CHAT, SYSTEM_PROMPT_SUMMARY
+
+# ---------------------------------------------------------------------
+# LOGS
+# ---------------------------------------------------------------------
+# Mensagens de debug só aparecem com LOG_LEVEL=DEBUG; no nível padrão (INFO)
+# nem chegam a ser formatadas.
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+log = logging.getLogger(__name__)
 
 # ---------------------------------------------------------------------
-# CONFIGURAÇÃO BÁSICA DO FLASK
+# CONFIGURAÇÃO BÁSICA DO QUART (ASGI)
 # ---------------------------------------------------------------------
 
-app = Flask(
+app = Quart(
     __name__,
     static_folder="static",
     static_url_path=""
 )
 
+# O Quart limita o corpo das requisições (16 MB / 60 s por padrão); PDFs grandes
+# precisam de mais. Ajustável por MAX_UPLOAD_MB e BODY_TIMEOUT (segundos).
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", 100))
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
+app.config["BODY_TIMEOUT"] = int(os.environ.get("BODY_TIMEOUT", 300))
+
 # ---------------------------------------------------------------------
 # CONFIG OPENAI
 # ---------------------------------------------------------------------
@@ -23,59 +50,558 @@ OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
 client = None
 if OPENAI_API_KEY:
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    # Um único cliente HTTP/2 para o processo todo, com pool grande de conexões
+    # mantidas abertas: evita refazer DNS + TLS a cada chamada sob carga.
+    client = AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        ),
+    )
+
+# ---------------------------------------------------------------------
+# PROMPTS
+# ---------------------------------------------------------------------
+# Mensagens de sistema fixas (textos em prompts.py), sempre as primeiras da
+# lista: o prefixo idêntico entre chamadas é o que permite o cache de prompt
+# da OpenAI reaproveitá-lo.
+
+SYSTEM_MSG_CHAT = {"role": "system", "content": SYSTEM_PROMPT_CHAT}
+SYSTEM_MSG_RESUMO = {"role": "system", "content": SYSTEM_PROMPT_SUMMARY}
+
+# O que fazer com a conversa quando chega um arquivo novo:
+#   append  mantém o histórico e acrescenta o resumo do arquivo (padrão)
+#   reset   começa uma conversa nova, só com o arquivo
+UPLOAD_HISTORY_MODE = os.environ.get("UPLOAD_HISTORY_MODE", "append").lower()
+if UPLOAD_HISTORY_MODE not in ("append", "reset"):
+    raise RuntimeError(
+        f"UPLOAD_HISTORY_MODE inválido: {UPLOAD_HISTORY_MODE!r} (use append ou reset)"
+    )
+
+# ---------------------------------------------------------------------
+# MEMÓRIA POR USUÁRIO
+# ---------------------------------------------------------------------
+
+MAX_CLIENTES = 10_000              # client_ids mantidos em memória
+
+# Trechos de arquivos com embeddings pesam MBs por cliente, então têm limites
+# próprios: poucos clientes e um teto de memória (texto + vetores) no total.
+MAX_CLIENTES_COM_VETORES = 1_000
+MEMORIA_ARQUIVOS_MB = int(os.environ.get("MEMORIA_ARQUIVOS_MB", 512))
+MAX_MENSAGENS_HISTORICO = 40       # mensagens guardadas por client_id
+
+# Passando de LIMITE_RESUMO_HISTORICO mensagens, as mais antigas viram um resumo
+# (em segundo plano) e só as MENSAGENS_RECENTES últimas continuam inteiras.
+# LIMITE_RESUMO_HISTORICO também é o máximo de mensagens enviadas ao modelo,
+# mesmo que o resumo falhe.
+LIMITE_RESUMO_HISTORICO = 16
+MENSAGENS_RECENTES = 12            # ~6 trocas
+
+# Texto de cada mensagem (e do total) que entra no pedido de resumo do histórico
+MAX_CHARS_MENSAGEM_RESUMO = 1000
+MAX_CHARS_CONVERSA_RESUMO = 16000
+
+
+class PorCliente:
+    """
+    Dicionário por client_id com número máximo de clientes.
+    Como um defaultdict, cria o valor no primeiro acesso; quando passa do limite,
+    descarta o client_id usado há mais tempo.
+    Com max_bytes, os valores precisam ter o atributo `tamanho` (bytes ocupados)
+    e aparar() também descarta clientes antigos até o total caber no limite.
+    """
+
+    def __init__(self, fabrica, max_clientes: int = MAX_CLIENTES, max_bytes: int | None = None):
+        self.fabrica = fabrica
+        self.max_clientes = max_clientes
+        self.max_bytes = max_bytes
+        self.dados = OrderedDict()
+
+    def __getitem__(self, client_id: str):
+        try:
+            valor = self.dados[client_id]
+            self.dados.move_to_end(client_id)
+        except KeyError:
+            valor = self.dados[client_id] = self.fabrica()
+            if len(self.dados) > self.max_clientes:
+                self.dados.popitem(last=False)
+        return valor
+
+    def __contains__(self, client_id: str) -> bool:
+        return client_id in self.dados
+
+    def pop(self, client_id: str, padrao=None):
+        return self.dados.pop(client_id, padrao)
+
+    def aparar(self):
+        """
+        Chamado depois que um valor cresce: respeita max_bytes descartando os
+        clientes usados há mais tempo (o mais recente sempre fica).
+        """
+        if self.max_bytes is None:
+            return
+        total = sum(valor.tamanho for valor in self.dados.values())
+        while total > self.max_bytes and len(self.dados) > 1:
+            _, valor = self.dados.popitem(last=False)
+            total -= valor.tamanho
+
+
+class HistoricoCliente:
+    """
+    Mensagens de um client_id (o deque descarta sozinho as mais antigas).
+    Quem vai ler e depois escrever no histórico segura o lock, para que
+    requisições simultâneas do mesmo cliente não intercalem os turnos.
+    """
+
+    def __init__(self):
+        self.mensagens = deque(maxlen=MAX_MENSAGENS_HISTORICO)
+        self.lock = asyncio.Lock()
+        self.resumo = ""          # resumo das mensagens que já saíram do deque
+        self.resumindo = False
+
+    def append(self, mensagem: dict):
+        self.mensagens.append(mensagem)
+
+    def __len__(self) -> int:
+        return len(self.mensagens)
+
+    def __getitem__(self, indice: int) -> dict:
+        return self.mensagens[indice]
+
+    def __iter__(self):
+        return iter(self.mensagens)
+
+
+# Memória por usuário (cada navegador tem um client_id diferente).
+# Fica na memória do processo: com vários processos, cada um tem a sua.
+conversation_histories = PorCliente(HistoricoCliente)
+
+# ---------------------------------------------------------------------
+# CACHE DE RESPOSTAS
+# ---------------------------------------------------------------------
+
+MODELO_EMBEDDING = "text-embedding-3-small"
+LOTE_EMBEDDINGS = 256          # textos por chamada de embeddings
+LOTES_EMBEDDINGS_SIMULTANEOS = 4
+LIMIAR_SIMILARIDADE = 0.9      # cosseno mínimo para reaproveitar uma resposta
+MAX_ENTRADAS_CACHE = 5000      # compartilhado entre todos os client_ids
+MAX_CHARS_EMBEDDING = 8000     # mensagens maiores só usam o cache exato
+MAX_RESUMOS_CACHE = 256
+
+
+class CacheSemantico:
+    """
+    Respostas já geradas para perguntas feitas sem contexto: primeira mensagem da
+    conversa, sem resumo e sem arquivo enviado. Aí a resposta depende só da
+    pergunta, então o cache é um só para todos os client_ids (perguntas frequentes
+    de usuários diferentes se aproveitam). Perguntas no meio de uma conversa
+    dependem do que veio antes ("sim", "e o segundo?") e não passam por aqui.
+
+    Primeiro tenta o texto exato (hash blake2b), depois a pergunta mais parecida
+    por similaridade de cosseno entre embeddings normalizados. Os vetores ficam
+    numa matriz circular de tamanho fixo, sobrescrevendo os mais antigos.
+    """
+
+    def __init__(self, max_entradas: int):
+        self.max_entradas = max_entradas
+        self.exatas = {}
+        self.vetores = None  # matriz float32 (max_entradas, dim), criada no 1º vetor
+        self.respostas = [None] * max_entradas
+        self.gravados = 0    # vetores já guardados; o próximo vai em gravados % max
+
+    def buscar_exata(self, chave: bytes):
+        return self.exatas.get(chave)
+
+    def buscar_similar(self, vetor):
+        n = min(self.gravados, self.max_entradas)
+        if n == 0:
+            return None
+        similaridades = self.vetores[:n] @ vetor
+        melhor = int(np.argmax(similaridades))
+        if similaridades[melhor] >= LIMIAR_SIMILARIDADE:
+            return self.respostas[melhor]
+        return None
+
+    def guardar(self, chave: bytes, vetor, resposta: str):
+        self.exatas[chave] = resposta
+        if len(self.exatas) > self.max_entradas:
+            # dict mantém ordem de inserção: remove a entrada mais antiga
+            del self.exatas[next(iter(self.exatas))]
+
+        if vetor is None:
+            return
+        if self.vetores is None:
+            self.vetores = np.zeros((self.max_entradas, vetor.shape[0]), dtype=np.float32)
+        posicao = self.gravados % self.max_entradas
+        self.vetores[posicao] = vetor
+        self.respostas[posicao] = resposta
+        self.gravados += 1
+
+
+# Cache de respostas do chat para perguntas sem contexto, de todos os clientes
+# (~6 KB de vetor + texto por entrada)
+cache_respostas = CacheSemantico(MAX_ENTRADAS_CACHE)
+
+# Resumos já feitos, pelo hash do texto resumido
+resumos_cache = {}
 
-# Memória por usuário (cada navegador tem um client_id diferente)
-conversation_histories = defaultdict(list)
+
+def chave_texto(texto: str) -> bytes:
+    return hashlib.blake2b(texto.encode("utf-8")).digest()
+
+
+# Limita os lotes em andamento no processo todo (indexação de arquivos), para
+# não estourar o rate limit da OpenAI com rajadas de chamadas
+_semaforo_embeddings = asyncio.Semaphore(LOTES_EMBEDDINGS_SIMULTANEOS)
+
+
+async def _embeddings_lote(lote: list[str], limitar: bool):
+    if not limitar:
+        return await client.embeddings.create(model=MODELO_EMBEDDING, input=lote)
+    async with _semaforo_embeddings:
+        return await client.embeddings.create(model=MODELO_EMBEDDING, input=lote)
+
+
+async def gerar_embeddings(textos: list[str], limitar: bool = True):
+    """
+    Devolve uma matriz float32 com um embedding normalizado por texto, ou None se não der.
+    Textos longos são enviados em lotes, no máximo LOTES_EMBEDDINGS_SIMULTANEOS por vez
+    (limitar=False pula essa fila, para a pergunta do chat não esperar uploads).
+    """
+    if client is None:
+        return None
+
+    lotes = [textos[i:i + LOTE_EMBEDDINGS] for i in range(0, len(textos), LOTE_EMBEDDINGS)]
+    try:
+        respostas = await asyncio.gather(*(_embeddings_lote(lote, limitar) for lote in lotes))
+    except Exception as e:
+        log.error("Erro ao chamar OpenAI (embedding): %r", e)
+        return None
+
+    vetores = np.asarray(
+        [item.embedding for resposta in respostas for item in resposta.data],
+        dtype=np.float32,
+    )
+    normas = np.linalg.norm(vetores, axis=1, keepdims=True)
+    normas[normas == 0] = 1
+    return vetores / normas
+
+
+async def gerar_embedding(texto: str):
+    """
+    Devolve o embedding normalizado (float32) do texto, ou None se não der.
+    """
+    if len(texto) > MAX_CHARS_EMBEDDING:
+        return None
+    vetores = await gerar_embeddings([texto], limitar=False)
+    return None if vetores is None else vetores[0]
+
+# ---------------------------------------------------------------------
+# ARQUIVOS ENVIADOS (BUSCA POR TRECHOS)
+# ---------------------------------------------------------------------
+
+TAMANHO_TRECHO = 2000          # ~500 tokens
+SOBREPOSICAO_TRECHO = 200
+TRECHOS_POR_PERGUNTA = 4
+MAX_TRECHOS_POR_CLIENTE = 2000
+
+
+def dividir_em_trechos(texto: str) -> list[str]:
+    """
+    Divide o texto em janelas de ~TAMANHO_TRECHO caracteres, cortando em espaço
+    sempre que possível e repetindo um pedaço do final no trecho seguinte.
+    """
+    trechos = []
+    inicio = 0
+    while inicio < len(texto):
+        fim = min(inicio + TAMANHO_TRECHO, len(texto))
+        if fim < len(texto):
+            espaco = texto.rfind(" ", inicio + TAMANHO_TRECHO // 2, fim)
+            if espaco != -1:
+                fim = espaco
+        trecho = texto[inicio:fim].strip()
+        if trecho:
+            trechos.append(trecho)
+        if fim == len(texto):
+            break
+        inicio = fim - SOBREPOSICAO_TRECHO
+    return trechos
+
+
+class TrechosArquivos:
+    """
+    Trechos dos arquivos enviados por um client_id e seus embeddings.
+    """
+
+    def __init__(self):
+        self.trechos = []
+        self.vetores = None  # matriz float32 (n, dim), uma linha por trecho
+        self.tamanho = 0     # bytes aproximados (vetores + texto dos trechos)
+
+    def adicionar(self, nome: str, trechos: list[str], vetores):
+        rotulados = [f"[{nome}]\n{trecho}" for trecho in trechos]
+        if self.vetores is None:
+            self.vetores = vetores
+        else:
+            self.vetores = np.vstack([self.vetores, vetores])
+        self.trechos.extend(rotulados)
+
+        # Mantém só os trechos mais recentes
+        self.vetores = self.vetores[-MAX_TRECHOS_POR_CLIENTE:]
+        del self.trechos[:-MAX_TRECHOS_POR_CLIENTE]
+
+        self.tamanho = self.vetores.nbytes + sum(len(t) for t in self.trechos)
+
+    def buscar(self, vetor, k: int = TRECHOS_POR_PERGUNTA) -> list[str]:
+        if not self.trechos:
+            return []
+        similaridades = self.vetores @ vetor
+        if len(self.trechos) > k:
+            melhores = np.argpartition(similaridades, -k)[-k:]
+        else:
+            melhores = np.arange(len(self.trechos))
+        melhores = melhores[np.argsort(-similaridades[melhores])]
+        return [self.trechos[i] for i in melhores]
+
+
+# Trechos dos arquivos enviados, por client_id. No histórico vai só o resumo;
+# a cada pergunta entram apenas os trechos mais parecidos com ela.
+file_contexts = PorCliente(
+    TrechosArquivos, MAX_CLIENTES_COM_VETORES, MEMORIA_ARQUIVOS_MB * 1024 * 1024
+)
+
+MAX_ARQUIVOS_GUARDADOS = 64
+MEMORIA_DOWNLOADS_MB = int(os.environ.get("MEMORIA_DOWNLOADS_MB", 256))
+TAMANHO_PEDACO_DOWNLOAD = 64 * 1024
+
+
+class ArquivosEnviados:
+    """
+    Texto completo dos arquivos enviados, por file_id. Guarda no máximo
+    max_arquivos e max_bytes (aproximados pelo tamanho do texto), descartando
+    os mais antigos; o mais recente sempre fica.
+    """
+
+    def __init__(self, max_arquivos: int, max_bytes: int):
+        self.max_arquivos = max_arquivos
+        self.max_bytes = max_bytes
+        self.textos = OrderedDict()
+        self.tamanho = 0
+
+    def guardar(self, file_id: str, texto: str):
+        self.textos[file_id] = texto
+        self.tamanho += len(texto)
+        while len(self.textos) > 1 and (
+            len(self.textos) > self.max_arquivos or self.tamanho > self.max_bytes
+        ):
+            _, antigo = self.textos.popitem(last=False)
+            self.tamanho -= len(antigo)
+
+    def get(self, file_id: str):
+        return self.textos.get(file_id)
+
+
+# Para quem quiser baixar o texto em /api/file/<file_id>
+# (a rota de upload devolve só prévia e resumo).
+arquivos_enviados = ArquivosEnviados(
+    MAX_ARQUIVOS_GUARDADOS, MEMORIA_DOWNLOADS_MB * 1024 * 1024
+)
+
+
+async def indexar_arquivo(client_id: str, nome: str, conteudo: str):
+    """
+    Divide o arquivo em trechos, calcula os embeddings em lote e guarda para o client_id.
+    """
+    trechos = dividir_em_trechos(conteudo)
+    if not trechos:
+        return
+    if len(trechos) > MAX_TRECHOS_POR_CLIENTE:
+        # Corta antes de gerar embeddings: não paga pelo que seria descartado
+        log.warning(
+            "Arquivo '%s' de %s tem %d trechos; só os primeiros %d serão usados nas buscas",
+            nome, client_id, len(trechos), MAX_TRECHOS_POR_CLIENTE,
+        )
+        trechos = trechos[:MAX_TRECHOS_POR_CLIENTE]
+    vetores = await gerar_embeddings(trechos)
+    if vetores is None:
+        return
+    file_contexts[client_id].adicionar(nome, trechos, vetores)
+    file_contexts.aparar()
 
 # ---------------------------------------------------------------------
 # FUNÇÕES DE IA
 # ---------------------------------------------------------------------
 
-def gerar_resposta_agente(client_id: str) -> str:
+async def gerar_resposta_agente_stream(client_id: str, history: HistoricoCliente):
     """
-    Usa o histórico de conversa do client_id informado para gerar a próxima resposta.
+    Usa o histórico de conversa do client_id (já com o lock do turno) para gerar
+    a próxima resposta, entregando o texto em pedaços à medida que o modelo gera.
     """
     if client is None:
-        return (
+        yield (
             "Erro: a chave da OpenAI não está configurada.\n"
             "Defina a variável de ambiente OPENAI_API_KEY antes de rodar o servidor."
         )
-
-    history = conversation_histories[client_id]
+        return
 
     if not history:
-        return "Pode repetir? Ainda não recebi nenhuma mensagem na conversa."
+        yield "Pode repetir? Ainda não recebi nenhuma mensagem na conversa."
+        return
+
+    ultima = history[-1]
+    tem_arquivos = client_id in file_contexts
+
+    # Pergunta sem contexto (abre a conversa, sem resumo nem arquivo): se ela já
+    # foi respondida, igual ou parecida, devolve a resposta guardada sem chamar o modelo
+    chave = vetor = None
+    sem_contexto = (
+        ultima["role"] == "user" and len(history) == 1
+        and not history.resumo and not tem_arquivos
+    )
+    if sem_contexto:
+        chave = chave_texto(ultima["content"])
+        guardada = cache_respostas.buscar_exata(chave)
+        if guardada is not None:
+            yield guardada
+            return
+
+    # O embedding da pergunta só é calculado quando vai ser usado: busca no
+    # cache (sem contexto) ou nos trechos dos arquivos do cliente
+    if ultima["role"] == "user" and (sem_contexto or tem_arquivos):
+        vetor = await gerar_embedding(ultima["content"])
+
+    if sem_contexto and vetor is not None:
+        guardada = cache_respostas.buscar_similar(vetor)
+        if guardada is not None:
+            yield guardada
+            return
+
+    # Trechos dos arquivos enviados que mais se parecem com a pergunta
+    trechos_msg = []
+    if vetor is not None and tem_arquivos:
+        trechos = file_contexts[client_id].buscar(vetor)
+        if trechos:
+            trechos_msg = [{
+                "role": "system",
+                "content": (
+                    "Trechos dos arquivos enviados pelo usuário que podem ajudar "
+                    "a responder:\n\n" + "\n\n---\n\n".join(trechos)
+                ),
+            }]
+
+    # O histórico fica curto porque as mensagens antigas viram resumo
+    # (ver resumir_historico); entre um resumo e outro ele só cresce no fim,
+    # então sistema + resumo + mensagens anteriores formam um prefixo estável.
+    # Se o resumo atrasar ou falhar, o corte garante um limite mesmo assim.
+    recentes = islice(history, max(0, len(history) - LIMITE_RESUMO_HISTORICO), None)
 
-    # Usa só as últimas 10 trocas pra não estourar tokens
-    contexto = history[-10:]
+    resumo_msg = []
+    if history.resumo:
+        resumo_msg = [{
+            "role": "system",
+            "content": f"Resumo da conversa até agora: {history.resumo}",
+        }]
 
+    partes = []
     try:
-        resposta = client.chat.completions.create(
+        resposta = await client.chat.completions.create(
             model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Você é um assistente virtual chamado Agente B. "
-                        "Você fala em Português Brasileiro, de forma clara, objetiva e amigável. "
-                        "O usuário que está conversando com você é simplesmente chamado de 'usuário'. "
-                        "Responda sempre de forma educada, útil e focada na pergunta."
-                    ),
-                },
-                *contexto
-            ],
+            # Os trechos mudam a cada pergunta, então vão depois do histórico
+            # para não quebrar o prefixo reaproveitável
+            messages=[SYSTEM_MSG_CHAT, *resumo_msg, *recentes, *trechos_msg],
             max_tokens=800,
             temperature=0.3,
+            stream=True,
+        )
+        async for chunk in resposta:
+            if not chunk.choices:
+                continue
+            pedaco = chunk.choices[0].delta.content
+            if not partes and pedaco:
+                pedaco = pedaco.lstrip()
+            if pedaco:
+                partes.append(pedaco)
+                yield pedaco
+    except Exception as e:
+        log.error("Erro ao chamar OpenAI (chat): %r", e)
+        yield f"Tive um problema ao falar com o modelo de IA.\nDetalhe técnico: {e}"
+        return
+
+    if chave is not None:
+        cache_respostas.guardar(chave, vetor, "".join(partes).strip())
+
+
+
+# Tarefas em segundo plano precisam de uma referência forte até terminarem
+tarefas_em_segundo_plano = set()
+
+NOMES_PAPEIS = {"user": "Usuário", "assistant": "Agente B", "system": "Sistema"}
+
+
+def agendar_resumo_historico(history: HistoricoCliente):
+    """
+    Se o histórico passou do limite, resume as mensagens antigas em segundo plano.
+    """
+    if client is None or history.resumindo or len(history) <= LIMITE_RESUMO_HISTORICO:
+        return
+    history.resumindo = True
+    tarefa = asyncio.create_task(resumir_historico(history))
+    tarefas_em_segundo_plano.add(tarefa)
+    tarefa.add_done_callback(tarefas_em_segundo_plano.discard)
+
+
+async def resumir_historico(history: HistoricoCliente):
+    """
+    Junta o resumo anterior e as mensagens mais antigas num novo resumo de um parágrafo
+    e tira essas mensagens do histórico, deixando só as MENSAGENS_RECENTES.
+    """
+    try:
+        async with history.lock:
+            antigas = list(islice(history, 0, len(history) - MENSAGENS_RECENTES))
+            resumo_anterior = history.resumo
+
+        # Mensagens enormes (um documento colado, p. ex.) são cortadas: o pedido
+        # de resumo precisa caber no contexto do modelo, senão falha sempre
+        conversa = "\n".join(
+            f"{NOMES_PAPEIS.get(m['role'], m['role'])}: {m['content'][:MAX_CHARS_MENSAGEM_RESUMO]}"
+            for m in antigas
+        )
+        if resumo_anterior:
+            conversa = f"Resumo anterior: {resumo_anterior}\n\n{conversa}"
+        conversa = conversa[:MAX_CHARS_CONVERSA_RESUMO]
+
+        prompt = (
+            "Resuma em um único parágrafo a conversa abaixo entre o usuário e o Agente B, "
+            "mantendo fatos, pedidos, arquivos citados e decisões importantes.\n\n"
+            f"Conversa:\n{conversa}"
         )
-        texto = resposta.choices[0].message.content
-        return texto.strip()
+        resposta = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                SYSTEM_MSG_RESUMO,
+                {"role": "user", "content": prompt},
+            ],
+            max_tokens=400,
+            temperature=0.2,
+        )
+        novo_resumo = resposta.choices[0].message.content.strip()
+
+        # Durante a chamada o histórico pode ter recebido mensagens novas (ou
+        # perdido as mais antigas pelo limite do deque): remove só as resumidas
+        async with history.lock:
+            for mensagem in antigas:
+                if history.mensagens and history.mensagens[0] is mensagem:
+                    history.mensagens.popleft()
+            history.resumo = novo_resumo
     except Exception as e:
-        print("Erro ao chamar OpenAI (chat):", repr(e))
-        return f"Tive um problema ao falar com o modelo de IA.\nDetalhe técnico: {e}"
+        log.error("Erro ao chamar OpenAI (resumo do histórico): %r", e)
+    finally:
+        history.resumindo = False
 
 
-def resumir_texto(conteudo: str) -> str:
+async def resumir_texto(conteudo: str) -> str:
     """
     Resumo inteligente de um texto enviado em arquivo.
     """
@@ -84,6 +610,10 @@ def resumir_texto(conteudo: str) -> str:
 
     trecho = conteudo[:8000]
 
+    chave = chave_texto(trecho)
+    if chave in resumos_cache:
+        return resumos_cache[chave]
+
     prompt = (
         "Resuma o texto completo abaixo, em português claro, "
         "destacando ideias principais, tópicos importantes e conclusões.\n\n"
@@ -91,42 +621,36 @@ def resumir_texto(conteudo: str) -> str:
     )
 
     try:
-        resposta = client.chat.completions.create(
+        resposta = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Você é um assistente que faz resumos completos, claros e organizados "
-                        "em português brasileiro."
-                    ),
-                },
+                SYSTEM_MSG_RESUMO,
                 {"role": "user", "content": prompt},
             ],
             max_tokens=600,
             temperature=0.25,
         )
-        return resposta.choices[0].message.content.strip()
+        resumo = resposta.choices[0].message.content.strip()
     except Exception as e:
-        print("Erro ao chamar OpenAI (resumo):", repr(e))
+        log.error("Erro ao chamar OpenAI (resumo): %r", e)
         return f"Não consegui resumir o texto por um erro técnico: {e}"
 
-def gerar_audio_openai(texto: str) -> str:
+    resumos_cache[chave] = resumo
+    if len(resumos_cache) > MAX_RESUMOS_CACHE:
+        del resumos_cache[next(iter(resumos_cache))]
+    return resumo
+
+async def gerar_audio_openai(texto: str):
     """
-    Gera um arquivo MP3 com a voz da OpenAI e devolve o caminho temporário do arquivo.
+    Gera MP3 com a voz da OpenAI, entregando os bytes em pedaços à medida que chegam
+    (sem passar por arquivo temporário).
     Versão usando streaming oficial (mais estável).
     """
     if client is None:
         raise RuntimeError("OpenAI não configurada")
 
-    # cria arquivo temporário
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-    tmp_path = tmp.name
-    tmp.close()
-
     try:
-        # Versão recomendada pela OpenAI: with_streaming_response + stream_to_file
-        with client.audio.speech.with_streaming_response.create(
+        async with client.audio.speech.with_streaming_response.create(
             model="gpt-4o-mini-tts",
             voice="alloy",
             input=texto,
@@ -135,175 +659,338 @@ def gerar_audio_openai(texto: str) -> str:
                 "pronúncia clara e ritmo de leitura natural."
             ),
         ) as response:
-            response.stream_to_file(tmp_path)
+            async for chunk in response.iter_bytes(chunk_size=8192):
+                yield chunk
 
     except Exception as e:
-        print("Erro ao gerar TTS:", repr(e))
-        # apaga o arquivo se der erro
-        try:
-            os.unlink(tmp_path)
-        except OSError:
-            pass
+        log.error("Erro ao gerar TTS: %r", e)
         # repassa o erro para ser tratado na rota /api/tts
         raise
 
-    return tmp_path
+# ---------------------------------------------------------------------
+# LEITURA DE ARQUIVOS
+# ---------------------------------------------------------------------
+
+# Extensões lidas como texto puro
+EXTENSOES_TEXTO = frozenset({"txt", "md", "csv", "json", "log"})
+
+# As primeiras páginas são lidas num lote só; se o PDF tiver mais que isso,
+# o resto é dividido em lotes extraídos em paralelo.
+MIN_PAGINAS_POR_LOTE = 8
+
+# Processos do pool de PDF: os núcleos são divididos entre os WEB_CONCURRENCY
+# processos do servidor (cada um tem o seu pool).
+PDF_WORKERS = int(os.environ.get(
+    "PDF_WORKERS",
+    max(1, (os.cpu_count() or 1) // int(os.environ.get("WEB_CONCURRENCY", 1))),
+))
+
+# Cada lote leva uma cópia dos bytes do PDF para o processo que o executa.
+# PDFs grandes são divididos em menos lotes para que as cópias somem no máximo
+# isso (o próprio pool também limita: só PDF_WORKERS + 1 chamadas em trânsito).
+MAX_MB_COPIAS_PDF = int(os.environ.get("MAX_MB_COPIAS_PDF", 256))
+
+# O PDFium não é thread-safe (nem com um documento por thread), então toda a
+# extração roda num pool de processos: o event loop continua livre e os lotes
+# rodam em paralelo sem disputar o GIL. O pool é criado no primeiro PDF, e os
+# processos executam pdf_texto.extrair_paginas_pdf.
+_pool_pdf = None
+
+
+def pool_pdf() -> ProcessPoolExecutor:
+    global _pool_pdf
+    if _pool_pdf is None:
+        _pool_pdf = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            # spawn: não herda threads/locks do servidor como o fork faria
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool_pdf
+
+
+async def extrair_texto_pdf(dados: bytes) -> str:
+    """
+    Extrai o texto de um PDF direto da memória (sem passar por arquivo temporário),
+    fora do event loop.
+    """
+    pool = pool_pdf()
+    try:
+        return await _extrair_no_pool(pool, dados)
+    except BrokenProcessPool:
+        # Um processo do pool morreu (PDF que derruba o pdfium, OOM...) e o pool
+        # fica inutilizável: descarta e tenta uma vez num pool novo
+        log.warning("Pool de extração de PDF quebrado; recriando")
+        descartar_pool_pdf(pool)
+
+    pool = pool_pdf()
+    try:
+        return await _extrair_no_pool(pool, dados)
+    except BrokenProcessPool:
+        # Sem pool quebrado para trás: o próximo upload cria outro
+        descartar_pool_pdf(pool)
+        raise
+
+
+def descartar_pool_pdf(pool: ProcessPoolExecutor):
+    global _pool_pdf
+    # Outro upload pode já ter trocado o pool global por um novo
+    if _pool_pdf is pool:
+        _pool_pdf = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def _extrair_no_pool(pool: ProcessPoolExecutor, dados: bytes) -> str:
+    loop = asyncio.get_running_loop()
+    total, partes = await loop.run_in_executor(
+        pool, extrair_paginas_pdf, dados, 0, MIN_PAGINAS_POR_LOTE
+    )
+    if total > MIN_PAGINAS_POR_LOTE:
+        # Um lote por processo do pool, mas sem passar do limite de cópias em memória
+        megabytes = max(1, len(dados) // (1024 * 1024))
+        paralelos = max(1, min(PDF_WORKERS, MAX_MB_COPIAS_PDF // megabytes))
+        restantes = total - MIN_PAGINAS_POR_LOTE
+        tamanho = max(MIN_PAGINAS_POR_LOTE, -(-restantes // paralelos))
+        lotes = await asyncio.gather(*(
+            loop.run_in_executor(pool, extrair_paginas_pdf, dados, inicio, inicio + tamanho)
+            for inicio in range(MIN_PAGINAS_POR_LOTE, total, tamanho)
+        ))
+        for _, textos in lotes:
+            partes.extend(textos)
+
+    return "\n\n".join(partes)
 
 # ---------------------------------------------------------------------
-# ROTAS FLASK
+# ROTAS
 # ---------------------------------------------------------------------
 
-@app.route("/")
-def index():
-    return send_from_directory(app.static_folder, "index.html")
+def evento_sse(dados: dict) -> str:
+    """
+    Formata um evento Server-Sent Events com um JSON (quebras de linha ficam escapadas).
+    """
+    return f"data: {json.dumps(dados, ensure_ascii=False)}\n\n"
 
 
-@app.route("/api/chat", methods=["POST"])
-def chat():
-    data = request.get_json() or {}
-    mensagem = data.get("message", "")
-    client_id = data.get("client_id", "anonimo")
+def resposta_sse(eventos) -> Response:
+    response = Response(eventos, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # Evita que proxies (nginx etc.) segurem os eventos em buffer
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
-    if not mensagem.strip():
-        return jsonify({"reply": "Pode repetir a pergunta? Não recebi nenhum texto."})
 
+async def eventos_resposta(client_id: str, mensagem: str, rota: str):
+    """
+    Grava a mensagem do usuário e gera a resposta do agente como eventos SSE:
+    {"delta": ...} para cada pedaço e, no fim, {"done": true, "reply": <resposta completa>},
+    já gravada no histórico.
+    """
     history = conversation_histories[client_id]
 
-    history.append({"role": "user", "content": mensagem})
+    # O turno inteiro (pergunta -> resposta) acontece com o lock do cliente:
+    # outra mensagem do mesmo client_id espera este turno terminar
+    async with history.lock:
+        history.append({"role": "user", "content": mensagem})
+
+        partes = []
+        # Passa o mesmo objeto que está com o lock: se o client_id for descartado
+        # ou resetado enquanto o turno espera, pergunta e resposta ficam juntas
+        async for pedaco in gerar_resposta_agente_stream(client_id, history):
+            partes.append(pedaco)
+            yield evento_sse({"delta": pedaco})
+
+        resposta = "".join(partes).strip()
+        history.append({"role": "assistant", "content": resposta})
 
-    resposta = gerar_resposta_agente(client_id)
+        log.debug("%s: client_id=%s, mensagens_no_historico=%d", rota, client_id, len(history))
 
-    history.append({"role": "assistant", "content": resposta})
+    agendar_resumo_historico(history)
+
+    yield evento_sse({"done": True, "reply": resposta})
+
+
+@app.errorhandler(413)
+async def arquivo_grande_demais(_erro):
+    return jsonify({"error": f"Arquivo grande demais (limite de {MAX_UPLOAD_MB} MB)."}), 413
+
+
+@app.errorhandler(408)
+async def envio_demorado_demais(_erro):
+    return jsonify({"error": "O envio demorou demais e foi interrompido. Tente novamente."}), 408
+
+
+@app.route("/")
+async def index():
+    return await send_from_directory(app.static_folder, "index.html")
+
+
+@app.route("/api/chat", methods=["POST"])
+async def chat():
+    """
+    Responde por Server-Sent Events: um evento {"delta": ...} para cada pedaço
+    gerado e, no fim, {"done": true, "reply": <resposta completa>}.
+    """
+    data = await request.get_json() or {}
+    mensagem = data.get("message", "")
+    client_id = data.get("client_id", "anonimo")
 
-    print(f"[DEBUG] /api/chat: client_id={client_id}, mensagens_no_historico={len(history)}")
+    # isspace() percorre o texto sem criar uma cópia (ao contrário de strip())
+    if not mensagem or mensagem.isspace():
+        aviso = "Pode repetir a pergunta? Não recebi nenhum texto."
+        return resposta_sse([evento_sse({"done": True, "reply": aviso})])
 
-    return jsonify({"reply": resposta})
+    return resposta_sse(eventos_resposta(client_id, mensagem, "/api/chat"))
 
 
 @app.route("/api/upload", methods=["POST"])
-def upload():
+async def upload():
     """
     Recebe um arquivo, lê o conteúdo (TXT ou PDF) e devolve prévia + resumo completo do PDF pela IA.
-    Também armazena o texto completo na memória do client_id para permitir perguntas sobre ele.
+    Guarda o texto completo à parte (disponível em /api/file/<file_id>) e coloca o
+    resumo no histórico do client_id.
     """
-    arquivo = request.files.get("file")
+    files = await request.files
+    form = await request.form
+
+    arquivo = files.get("file")
     if not arquivo:
         return jsonify({"error": "Nenhum arquivo enviado"}), 400
 
-    client_id = request.form.get("client_id", "anonimo")
+    client_id = form.get("client_id", "anonimo")
 
     nome = arquivo.filename or "arquivo"
-    ext = os.path.splitext(nome)[1].lower()
+    _, ponto, ext = nome.rpartition(".")
+    ext = ext.lower() if ponto else ""
 
     try:
-        if ext in [".txt", ".md", ".csv", ".json", ".log"]:
+        if ext in EXTENSOES_TEXTO:
             conteudo = arquivo.read().decode("utf-8", errors="ignore")
 
-        elif ext == ".pdf":
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                arquivo.save(tmp)
-                tmp_path = tmp.name
-
-            try:
-                reader = PdfReader(tmp_path)
-                partes = []
-                for page in reader.pages:
-                    texto_pagina = page.extract_text() or ""
-                    partes.append(texto_pagina)
-                conteudo = "\n\n".join(partes)
-            finally:
-                os.unlink(tmp_path)
+        elif ext == "pdf":
+            conteudo = await extrair_texto_pdf(arquivo.read())
         else:
             return jsonify({"error": "Tipo de arquivo não suportado. Use .txt ou .pdf."}), 400
 
     except Exception as e:
-        print("Erro ao processar arquivo:", repr(e))
+        log.error("Erro ao processar arquivo: %r", e)
         return jsonify({"error": f"Erro ao processar arquivo: {e}"}), 500
 
-    if not conteudo.strip():
+    if not conteudo or conteudo.isspace():
         return jsonify({
             "filename": nome,
-            "text": "",
             "preview": "",
             "summary": "Não foi possível extrair texto deste arquivo."
         })
 
     preview = conteudo[:1200]
-    resumo = resumir_texto(conteudo)
 
-    # NÃO limpamos o histórico inteiro; apenas acrescentamos a info do arquivo
+    if UPLOAD_HISTORY_MODE == "reset":
+        # Conversa nova: esquece histórico e arquivos anteriores
+        conversation_histories.pop(client_id)
+        file_contexts.pop(client_id)
+
+    resumo, _ = await asyncio.gather(
+        resumir_texto(conteudo),
+        indexar_arquivo(client_id, nome, conteudo),
+    )
+
+    # No modo append NÃO limpamos o histórico; apenas acrescentamos a info do arquivo.
     history = conversation_histories[client_id]
-    history.append({
-        "role": "system",
-        "content": (
-            f"O usuário enviou um arquivo chamado '{nome}'. "
-            f"Abaixo está o conteúdo completo do arquivo:\n\n{conteudo}"
-        )
-    })
+    async with history.lock:
+        history.append({
+            "role": "system",
+            "content": (
+                f"O usuário enviou um arquivo chamado '{nome}'. "
+                f"Resumo do conteúdo do arquivo:\n\n{resumo}"
+            )
+        })
 
-    print(f"[DEBUG] /api/upload: Conteúdo armazenado em {client_id} ({len(conteudo)} caracteres)")
+    file_id = uuid.uuid4().hex
+    arquivos_enviados.guardar(file_id, conteudo)
+
+    log.debug("/api/upload: conteúdo armazenado em %s (%d caracteres)", client_id, len(conteudo))
 
     return jsonify({
         "filename": nome,
-        "text": conteudo,
+        "file_id": file_id,
         "preview": preview,
         "summary": resumo,
     })
 
+
+@app.route("/api/file/<file_id>")
+async def texto_arquivo(file_id: str):
+    """
+    Devolve o texto completo extraído de um arquivo enviado, em pedaços de 64 KB.
+    """
+    conteudo = arquivos_enviados.get(file_id)
+    if conteudo is None:
+        return jsonify({"error": "Arquivo não encontrado"}), 404
+
+    async def pedacos():
+        for inicio in range(0, len(conteudo), TAMANHO_PEDACO_DOWNLOAD):
+            yield conteudo[inicio:inicio + TAMANHO_PEDACO_DOWNLOAD]
+
+    return Response(pedacos(), mimetype="text/plain")
+
 @app.route("/api/tts", methods=["POST"])
-def tts():
+async def tts():
     """
     Gera áudio MP3 com a voz da OpenAI a partir de um texto.
     """
-    data = request.get_json() or {}
+    data = await request.get_json() or {}
     texto = data.get("text", "")
 
-    if not texto.strip():
+    if not texto or texto.isspace():
         return jsonify({"error": "Texto vazio para TTS"}), 400
 
+    audio = gerar_audio_openai(texto)
     try:
-        mp3_path = gerar_audio_openai(texto)
-        return send_file(mp3_path, mimetype="audio/mpeg", as_attachment=False)
+        # Espera o primeiro pedaço antes de responder: se a OpenAI falhar,
+        # ainda dá tempo de devolver o erro em JSON
+        primeiro = await anext(audio, b"")
     except Exception as e:
-        print("Erro ao gerar TTS /api/tts:", repr(e))
+        log.error("Erro ao gerar TTS /api/tts: %r", e)
         return jsonify({"error": f"Falha ao gerar áudio: {e}"}), 500
 
+    async def corpo():
+        yield primeiro
+        async for chunk in audio:
+            yield chunk
+
+    return Response(corpo(), mimetype="audio/mpeg")
+
 @app.route("/api/stt", methods=["POST"])
-def stt_conversa():
+async def stt_conversa():
     """
-    Recebe um áudio (voz do usuário), transcreve para texto,
-    gera resposta no chat e devolve (texto do usuário + resposta).
+    Recebe um áudio (voz do usuário), transcreve para texto e gera resposta no chat.
+    Responde por Server-Sent Events: primeiro {"user_text": ...}, assim que a
+    transcrição termina, e depois a resposta em pedaços, como em /api/chat.
     """
     if client is None:
         return jsonify({"error": "OpenAI não configurada"}), 500
 
-    audio_file = request.files.get("audio")
-    client_id = request.form.get("client_id", "anonimo")
+    files = await request.files
+    form = await request.form
+
+    audio_file = files.get("audio")
+    client_id = form.get("client_id", "anonimo")
 
     if not audio_file:
         return jsonify({"error": "Nenhum áudio enviado"}), 400
 
     try:
-        # 1) Salvar áudio em arquivo temporário
+        # O Whisper descobre o formato pela extensão do nome do arquivo
         suffix = ".webm"
         nome_arquivo = audio_file.filename or ""
         if nome_arquivo.lower().endswith((".mp4", ".m4a", ".aac")):
             suffix = ".m4a"
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            audio_file.save(tmp)
-            tmp_path = tmp.name
-
-        try:
-            # 2) Abrir arquivo e mandar para Whisper
-            with open(tmp_path, "rb") as f:
-                transcription = client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=f,
-                    response_format="text",
-                )
-        finally:
-            os.unlink(tmp_path)
+        # Manda os bytes do upload direto para o Whisper (sem arquivo temporário)
+        transcription = await client.audio.transcriptions.create(
+            model="whisper-1",
+            file=(f"audio{suffix}", audio_file.read(), audio_file.mimetype or "audio/webm"),
+            response_format="text",
+        )
 
         if isinstance(transcription, str):
             user_text = transcription.strip()
@@ -311,24 +998,53 @@ def stt_conversa():
             user_text = str(transcription).strip()
 
     except Exception as e:
-        print("Erro ao transcrever áudio /api/stt:", repr(e))
+        log.error("Erro ao transcrever áudio /api/stt: %r", e)
         return jsonify({"error": f"Falha ao transcrever áudio: {e}"}), 500
 
-    # Adiciona fala no histórico
-    history = conversation_histories[client_id]
-    history.append({"role": "user", "content": user_text})
+    # Áudio sem fala: não vale a pena chamar o modelo de chat
+    if not user_text:
+        return jsonify({"error": "Não consegui entender nenhuma fala no áudio."}), 400
 
-    reply_text = gerar_resposta_agente(client_id)
-    history.append({"role": "assistant", "content": reply_text})
+    async def eventos():
+        yield evento_sse({"user_text": user_text})
+        # A fala entra no histórico junto com a resposta, no mesmo turno
+        async for evento in eventos_resposta(client_id, user_text, "/api/stt"):
+            yield evento
 
-    print(f"[DEBUG] /api/stt: client_id={client_id}, len_history={len(history)}")
+    return resposta_sse(eventos())
 
-    return jsonify({
-        "user_text": user_text,
-        "reply_text": reply_text,
-    })
 
+# ---------------------------------------------------------------------
+# SERVIDOR
+# ---------------------------------------------------------------------
+# Em produção o Procfile sobe o hypercorn (ASGI, event loop uvloop quando
+# instalado). Variáveis:
+#   PORT             porta HTTP (padrão 5000)
+#   WEB_CONCURRENCY  processos do servidor (padrão 1). Cada processo tem sua
+#                    própria memória de conversas, então mais de 1 só funciona
+#                    com afinidade de sessão no balanceador.
+# Dentro de cada processo o event loop já atende muitas requisições ao mesmo
+# tempo enquanto elas esperam a OpenAI.
+#
+# `python app.py` sobe o mesmo comando do Procfile num processo à parte. Se o
+# hypercorn rodasse aqui dentro, app.py seria o módulo principal e o spawn dos
+# processos de PDF o executaria de novo em cada um (como __mp_main__).
 
 if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+    import subprocess
+    import sys
+
+    # uvloop não existe no Windows (ver requirements.txt): cai para o asyncio padrão
+    try:
+        import uvloop  # noqa: F401
+        worker_class = "uvloop"
+    except ImportError:
+        worker_class = "asyncio"
+
+    sys.exit(subprocess.call([
+        sys.executable, "-m", "hypercorn", "app:app",
+        "--bind", f"0.0.0.0:{os.environ.get('PORT', 5000)}",
+        "--workers", os.environ.get("WEB_CONCURRENCY", "1"),
+        "--worker-class", worker_class,
+        "--keep-alive", "75",
+    ], cwd=os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,21 @@
+"""
+Extração de texto de PDF que roda nos processos do pool de app.py.
+
+Fica num módulo à parte, que só importa o pypdfium2: cada processo novo (spawn)
+importa este arquivo, e não o app inteiro (Quart, OpenAI, numpy...).
+"""
+import pypdfium2 as pdfium
+
+
+def extrair_paginas_pdf(dados: bytes, inicio: int, fim: int) -> tuple[int, list[str]]:
+    """
+    Extrai o texto das páginas [inicio, fim) de um PDF em memória.
+    Devolve também o total de páginas do documento.
+    """
+    pdf = pdfium.PdfDocument(dados)
+    try:
+        total = len(pdf)
+        textos = [pdf[i].get_textpage().get_text_range() for i in range(inicio, min(fim, total))]
+        return total, textos
+    finally:
+        pdf.close()